@@ -146,8 +146,14 @@ if [[ "$USE_SUDO" -eq 1 ]]; then
   DOCKER=(sudo docker)
 fi
 
-cmd=(
-  "${DOCKER[@]}" run -it --rm
+cmd=("${DOCKER[@]}" run --rm)
+
+# Only attach a TTY when there is one; concurrent batches are started with stdin closed
+if [[ -t 0 ]]; then
+  cmd+=(-it)
+fi
+
+cmd+=(
   -v "${INPUT_HOST}:/data:ro"
   -v "${OUTPUT_HOST}:/out"
 )
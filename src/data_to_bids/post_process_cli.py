@@ -1,7 +1,6 @@
 #!/usr/bin/env python3
 import argparse
 import os
-import subprocess
 import sys
 
 # Allow both:
@@ -12,17 +11,13 @@ try:
     from .post_process_core import (
         normalize_subject,
         normalize_session,
-        rename_fieldmap_files,
-        update_scans_tsv,
-        update_fieldmap_json,
+        process_subjects,
     )
 except ImportError:
     from post_process_core import (  # type: ignore
         normalize_subject,
         normalize_session,
-        rename_fieldmap_files,
-        update_scans_tsv,
-        update_fieldmap_json,
+        process_subjects,
     )
 
 
@@ -55,11 +50,30 @@ def build_parser() -> argparse.ArgumentParser:
         default="b0map_fmap0",
         help="Value for B0FieldIdentifier in fieldmap JSON.",
     )
+    p.add_argument(
+        "--strict",
+        action="store_true",
+        help="Parse *_scans.tsv with pandas and only edit the 'filename' column "
+             "(default: substitute directly in the file contents).",
+    )
+    p.add_argument(
+        "--scans-processes",
+        type=int,
+        default=None,
+        help="Rewrite *_scans.tsv files in this many worker processes after the directory walk "
+             "(default: rewrite them inline, per subject).",
+    )
     p.add_argument(
         "--dry-run",
         action="store_true",
         help="Print what would change, but do not modify files.",
     )
+    p.add_argument(
+        "--diff",
+        action="store_true",
+        help="Print a unified diff for each fieldmap JSON change. With --dry-run, fieldmap JSONs "
+             "are only read (to report actual changes) when this is set.",
+    )
 
     # Step selection: if none set, run all
     p.add_argument("--rename-files", action="store_true", help="Run only the file renaming step (or combine with others).")
@@ -91,10 +105,10 @@ def _maybe_rerun_with_sudo(args: argparse.Namespace) -> None:
     cmd = ["sudo", "-E", sys.executable, os.path.abspath(__file__)] + sys.argv[1:]
 
     print("Re-running with sudo:")
-    print("  " + " ".join(cmd))
+    print("  " + " ".join(cmd), flush=True)
 
-    subprocess.run(cmd, check=True)
-    raise SystemExit(0)
+    # Replace this process instead of waiting on a child; does not return
+    os.execvp("sudo", cmd)
 
 
 def main() -> int:
@@ -110,30 +124,19 @@ def main() -> int:
     run_scans = args.update_scans or not run_any
     run_json = args.update_json or not run_any
 
-    if run_rename:
-        rename_fieldmap_files(
-            subjects,
-            base_dir=args.base_dir,
-            sessions_filter=sessions_filter,
-            dry_run=args.dry_run,
-        )
-
-    if run_scans:
-        update_scans_tsv(
-            subjects,
-            base_dir=args.base_dir,
-            sessions_filter=sessions_filter,
-            dry_run=args.dry_run,
-        )
-
-    if run_json:
-        update_fieldmap_json(
-            subjects,
-            base_dir=args.base_dir,
-            sessions_filter=sessions_filter,
-            b0_identifier=args.b0_identifier,
-            dry_run=args.dry_run,
-        )
+    process_subjects(
+        subjects,
+        base_dir=args.base_dir,
+        sessions_filter=sessions_filter,
+        run_rename=run_rename,
+        run_scans=run_scans,
+        run_json=run_json,
+        b0_identifier=args.b0_identifier,
+        strict_scans=args.strict,
+        dry_run=args.dry_run,
+        show_diff=args.diff,
+        scans_processes=args.scans_processes,
+    )
 
     return 0
 
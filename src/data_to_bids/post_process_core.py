@@ -23,17 +23,63 @@ __version__ = "0.1.0"
 
 
 import os
-import glob
+import difflib
 import json
-from typing import Iterable, List, Optional
+import re
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterable, List, Optional, Tuple
 
-import pandas as pd
+try:
+    import orjson
+except ImportError:  # optional speedup; fall back to the stdlib encoder
+    orjson = None
 
+# BIDS names for the two HeuDiConv fieldmap outputs
+_FIELDMAP_RENAMES = {"fieldmap1": "magnitude", "fieldmap2": "fieldmap"}
+_FIELDMAP_RE = re.compile("fieldmap[12]")
 
+
+def _fieldmap_replacement(m: re.Match[str]) -> str:
+    return _FIELDMAP_RENAMES[m.group(0)]
+
+
+# Directory-relative renames (POSIX); falls back to absolute paths elsewhere (e.g. Windows)
+_HAVE_DIR_FD = (
+    hasattr(os, "O_DIRECTORY")
+    and os.rename in os.supports_dir_fd
+    and os.access in os.supports_dir_fd
+    and os.access in os.supports_follow_symlinks
+)
+
+# Subjects are processed in worker threads; serialize output so lines do not interleave
+_print_lock = threading.Lock()
+
+
+def _log(msg: str) -> None:
+    with _print_lock:
+        print(msg, flush=True)
+
+
+def _json_loads(data: bytes) -> dict:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _json_dumps(obj: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
+
+
+@lru_cache(maxsize=None)
 def normalize_subject(s: str) -> str:
     return s if s.startswith("sub-") else f"sub-{s}"
 
 
+@lru_cache(maxsize=None)
 def normalize_session(s: str) -> str:
     return s if s.startswith("ses-") else f"ses-{s}"
 
@@ -46,171 +92,424 @@ def iter_session_paths(subject_path: str, sessions_filter: Optional[List[str]] =
     if sessions_filter:
         for ses in sessions_filter:
             ses_path = os.path.join(subject_path, ses)
-            if os.path.isdir(ses_path):
-                yield ses_path
-            else:
-                print(f"Session directory not found: {ses_path}")
+            try:
+                with os.scandir(ses_path):
+                    pass
+            except (FileNotFoundError, NotADirectoryError):
+                _log(f"Session directory not found: {ses_path}")
+                continue
+            yield ses_path
     else:
-        for ses_path in sorted(glob.glob(os.path.join(subject_path, "ses-*"))):
-            if os.path.isdir(ses_path):
-                yield ses_path
+        with os.scandir(subject_path) as it:
+            ses_entries = [
+                e for e in it
+                if e.name.startswith("ses-") and e.is_dir()
+            ]
+        for entry in sorted(ses_entries, key=lambda e: e.name):
+            yield entry.path
 
 
-def rename_fieldmap_files(
-    subjects: List[str],
-    base_dir: str = ".",
-    sessions_filter: Optional[List[str]] = None,
-    dry_run: bool = False,
-) -> None:
+def _rename_session_fieldmaps(fmap_dir: str, dry_run: bool = False) -> None:
     """
-    Renames files in ses-*/fmap:
+    Renames files in a single fmap directory:
       fieldmap1 -> magnitude
       fieldmap2 -> fieldmap
+    Where supported, fmap_dir is opened once and files are renamed relative to that
+    directory descriptor instead of resolving the full path for every file.
     """
-    for subject in subjects:
-        subject_path = os.path.join(base_dir, subject)
-        if not os.path.isdir(subject_path):
-            print(f"Directory not found: {subject_path}")
-            continue
-
-        for ses_path in iter_session_paths(subject_path, sessions_filter=sessions_filter):
-            fmap_dir = os.path.join(ses_path, "fmap")
-            if not os.path.isdir(fmap_dir):
+    with os.scandir(fmap_dir) as it:
+        fmap_entries = sorted(
+            (e for e in it if e.is_file()),
+            key=lambda e: e.name,
+        )
+
+    dir_fd = os.open(fmap_dir, os.O_RDONLY | os.O_DIRECTORY) if _HAVE_DIR_FD else None
+    try:
+        for entry in fmap_entries:
+            filename = entry.name
+            src_path = entry.path
+
+            new_filename, n = _FIELDMAP_RE.subn(_fieldmap_replacement, filename)
+            if n == 0:
                 continue
 
-            for filename in sorted(os.listdir(fmap_dir)):
-                src_path = os.path.join(fmap_dir, filename)
-                if not os.path.isfile(src_path):
-                    continue
-
-                if "fieldmap1" in filename:
-                    new_filename = filename.replace("fieldmap1", "magnitude")
-                elif "fieldmap2" in filename:
-                    new_filename = filename.replace("fieldmap2", "fieldmap")
-                else:
-                    continue
+            dst_path = os.path.join(fmap_dir, new_filename)
 
-                dst_path = os.path.join(fmap_dir, new_filename)
+            if dir_fd is not None:
+                target_exists = os.access(new_filename, os.F_OK, dir_fd=dir_fd, follow_symlinks=False)
+            else:
+                target_exists = os.path.exists(dst_path)
 
-                if os.path.exists(dst_path):
-                    print(f"Skip rename (target exists): {src_path} -> {dst_path}")
-                    continue
+            if target_exists:
+                _log(f"Skip rename (target exists): {src_path} -> {dst_path}")
+                continue
 
-                if dry_run:
-                    print(f"Would rename: {src_path} -> {dst_path}")
+            if dry_run:
+                _log(f"Would rename: {src_path} -> {dst_path}")
+            else:
+                _log(f"Renaming: {src_path} -> {dst_path}")
+                if dir_fd is not None:
+                    os.rename(filename, new_filename, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
                 else:
-                    print(f"Renaming: {src_path} -> {dst_path}")
                     os.rename(src_path, dst_path)
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
 
 
-def update_scans_tsv(
-    subjects: List[str],
-    base_dir: str = ".",
-    sessions_filter: Optional[List[str]] = None,
-    dry_run: bool = False,
-) -> None:
+def _rewrite_scans_tsv(tsv_file: str, dry_run: bool = False) -> None:
     """
-    Updates *_scans.tsv in each session by replacing in the 'filename' column:
-      fieldmap1 -> magnitude
-      fieldmap2 -> fieldmap
+    Fast path: substitutes fieldmap1/fieldmap2 directly in the raw bytes of the TSV.
+    In scans.tsv the fieldmap names only occur in the 'filename' column, so this matches
+    the column-aware edit without parsing the table (use strict=True if that may not hold).
     """
-    for subject in subjects:
-        subject_path = os.path.join(base_dir, subject)
-        if not os.path.isdir(subject_path):
-            print(f"Directory not found: {subject_path}")
-            continue
+    with open(tsv_file, "rb") as f:
+        data = f.read()
 
-        for ses_path in iter_session_paths(subject_path, sessions_filter=sessions_filter):
-            for tsv_file in sorted(glob.glob(os.path.join(ses_path, "*_scans.tsv"))):
-                try:
-                    df = pd.read_csv(tsv_file, sep="\t")
+    header = data.split(b"\n", 1)[0].rstrip(b"\r").split(b"\t")
+    if b"filename" not in header:
+        _log(f"'filename' column not found in: {tsv_file}")
+        return
 
-                    if "filename" not in df.columns:
-                        print(f"'filename' column not found in: {tsv_file}")
-                        continue
+    new = data.replace(b"fieldmap1", b"magnitude").replace(b"fieldmap2", b"fieldmap")
+    if new == data:
+        _log(f"No changes needed for: {tsv_file}")
+        return
 
-                    original = df["filename"].copy()
+    changed_rows = sum(a != b for a, b in zip(data.splitlines(), new.splitlines()))
 
-                    df["filename"] = df["filename"].str.replace("fieldmap1", "magnitude", regex=False)
-                    df["filename"] = df["filename"].str.replace("fieldmap2", "fieldmap", regex=False)
+    if dry_run:
+        _log(f"Would update TSV ({changed_rows} rows): {tsv_file}")
+    else:
+        _log(f"Updating TSV ({changed_rows} rows): {tsv_file}")
+        with open(tsv_file, "wb") as f:
+            f.write(new)
 
-                    if df["filename"].equals(original):
-                        print(f"No changes needed for: {tsv_file}")
-                        continue
 
-                    changed_rows = int((df["filename"] != original).sum())
+def _rewrite_scans_tsv_strict(tsv_file: str, dry_run: bool = False) -> None:
+    """
+    Column-aware path: parses the TSV with pandas and only edits the 'filename' column.
+    """
+    # Imported here so the default (bytes) path and the other steps never load pandas
+    import pandas as pd
 
-                    if dry_run:
-                        print(f"Would update TSV ({changed_rows} rows): {tsv_file}")
-                    else:
-                        print(f"Updating TSV ({changed_rows} rows): {tsv_file}")
-                        df.to_csv(tsv_file, sep="\t", index=False)
+    df = pd.read_csv(tsv_file, sep="\t", dtype={"filename": "string"}, engine="c")
 
-                except Exception as e:
-                    print(f"Error processing {tsv_file}: {e}")
+    if "filename" not in df.columns:
+        _log(f"'filename' column not found in: {tsv_file}")
+        return
 
+    new_filenames = df["filename"].str.replace(
+        _FIELDMAP_RE, _fieldmap_replacement, regex=True
+    )
+    changed_rows = int((new_filenames.values != df["filename"].values).sum())
 
-def update_fieldmap_json(
+    if changed_rows == 0:
+        _log(f"No changes needed for: {tsv_file}")
+        return
+
+    df["filename"] = new_filenames
+
+    if dry_run:
+        _log(f"Would update TSV ({changed_rows} rows): {tsv_file}")
+    else:
+        _log(f"Updating TSV ({changed_rows} rows): {tsv_file}")
+        df.to_csv(tsv_file, sep="\t", index=False)
+
+
+def _update_session_scans(tsv_files: List[str], dry_run: bool = False, strict: bool = False) -> None:
+    """
+    Updates the given *_scans.tsv files by replacing in the 'filename' column:
+      fieldmap1 -> magnitude
+      fieldmap2 -> fieldmap
+    With strict=True the table is parsed with pandas so other columns are never touched.
+    """
+    rewrite = _rewrite_scans_tsv_strict if strict else _rewrite_scans_tsv
+    for tsv_file in tsv_files:
+        try:
+            rewrite(tsv_file, dry_run=dry_run)
+        except Exception as e:
+            _log(f"Error processing {tsv_file}: {e}")
+
+
+def _update_session_fieldmap_json(
+    subject: str,
+    ses_path: str,
+    func_dir: str,
+    fmap_dir: str,
+    base_dir: str = ".",
+    b0_identifier: str = "b0map_fmap0",
+    dry_run: bool = False,
+    show_diff: bool = False,
+) -> None:
+    """
+    Adds/updates IntendedFor and B0FieldIdentifier in the fieldmap JSON of a single session.
+    In dry-run mode the JSON is only read (and compared) when show_diff is set; otherwise
+    an existing fieldmap JSON is reported as "Would check/update" without opening it.
+    """
+    ses_id = os.path.basename(ses_path)
+    fmap_json_path = os.path.join(fmap_dir, f"{subject}_{ses_id}_fieldmap.json")
+
+    if dry_run and not show_diff:
+        if os.path.isfile(fmap_json_path):
+            _log(f"Would check/update JSON (not read; use --diff): {fmap_json_path}")
+        else:
+            _log(f"No fieldmap JSON found in: {fmap_dir} (expected: {fmap_json_path})")
+        return
+
+    with os.scandir(func_dir) as it:
+        bold_files = sorted(
+            e.path for e in it
+            if e.name.endswith("_bold.nii.gz") and e.is_file()
+        )
+
+    # Every path here was built by joining onto base_dir, so the dataset-relative part
+    # is a plain slice (no relpath/normpath per file).
+    prefix = os.path.join(base_dir, "")
+    assert all(bold_file.startswith(prefix) for bold_file in bold_files)
+    intended_for = [
+        "bids::" + bold_file[len(prefix):].replace(os.sep, "/")
+        for bold_file in bold_files
+    ]
+
+    try:
+        with open(fmap_json_path, "rb") as f:
+            existing = f.read()
+
+        fmap_data = _json_loads(existing)
+
+        new_data = dict(fmap_data)
+        new_data["IntendedFor"] = intended_for
+        new_data["B0FieldIdentifier"] = b0_identifier
+
+        # Compare parsed data, not bytes: orjson and json format floats differently, so a
+        # file written by the other backend would otherwise be rewritten on every run.
+        if new_data == fmap_data:
+            _log(f"No changes needed for: {fmap_json_path}")
+            return
+
+        new_bytes = _json_dumps(new_data)
+
+        if show_diff:
+            _log("".join(difflib.unified_diff(
+                existing.decode("utf-8").splitlines(keepends=True),
+                new_bytes.decode("utf-8").splitlines(keepends=True),
+                fromfile=fmap_json_path,
+                tofile=fmap_json_path,
+            )).rstrip("\n"))
+
+        if dry_run:
+            _log(f"Would update JSON: {fmap_json_path}")
+        else:
+            _log(f"Updating JSON: {fmap_json_path}")
+            with open(fmap_json_path, "wb") as f:
+                f.write(new_bytes)
+
+    except FileNotFoundError:
+        _log(f"No fieldmap JSON found in: {fmap_dir} (expected: {fmap_json_path})")
+    except Exception as e:
+        _log(f"Error updating {fmap_json_path}: {e}")
+
+
+def process_session(
+    subject: str,
+    ses_path: str,
+    *,
+    base_dir: str = ".",
+    run_rename: bool = True,
+    run_scans: bool = True,
+    run_json: bool = True,
+    b0_identifier: str = "b0map_fmap0",
+    strict_scans: bool = False,
+    dry_run: bool = False,
+    show_diff: bool = False,
+) -> List[str]:
+    """
+    Runs the selected post-processing steps on one session directory.
+    The session directory is listed once; fmap/, func/ and *_scans.tsv are resolved
+    from that listing and handed to each step (rename -> scans.tsv -> JSON).
+    Returns the session's *_scans.tsv paths.
+    """
+    fmap_dir = None
+    func_dir = None
+    tsv_files = []
+    with os.scandir(ses_path) as it:
+        for entry in it:
+            if entry.name == "fmap" and entry.is_dir():
+                fmap_dir = entry.path
+            elif entry.name == "func" and entry.is_dir():
+                func_dir = entry.path
+            elif entry.name.endswith("_scans.tsv") and entry.is_file():
+                tsv_files.append(entry.path)
+    tsv_files.sort()
+
+    if run_rename and fmap_dir is not None:
+        _rename_session_fieldmaps(fmap_dir, dry_run=dry_run)
+
+    if run_scans:
+        _update_session_scans(tsv_files, dry_run=dry_run, strict=strict_scans)
+
+    if run_json:
+        if func_dir is None or fmap_dir is None:
+            _log(f"Missing func or fmap directory in: {ses_path}")
+            return tsv_files
+        _update_session_fieldmap_json(
+            subject,
+            ses_path,
+            func_dir,
+            fmap_dir,
+            base_dir=base_dir,
+            b0_identifier=b0_identifier,
+            dry_run=dry_run,
+            show_diff=show_diff,
+        )
+
+    return tsv_files
+
+
+def _rewrite_one_tsv(task: Tuple[str, bool, bool]) -> None:
+    # Module-level so it can be pickled for ProcessPoolExecutor
+    tsv_file, dry_run, strict = task
+    _update_session_scans([tsv_file], dry_run=dry_run, strict=strict)
+
+
+def process_subjects(
     subjects: List[str],
     base_dir: str = ".",
     sessions_filter: Optional[List[str]] = None,
+    *,
+    run_rename: bool = True,
+    run_scans: bool = True,
+    run_json: bool = True,
     b0_identifier: str = "b0map_fmap0",
+    strict_scans: bool = False,
     dry_run: bool = False,
+    show_diff: bool = False,
+    max_workers: Optional[int] = None,
+    scans_processes: Optional[int] = None,
 ) -> None:
     """
-    Adds/updates IntendedFor and B0FieldIdentifier in the fieldmap JSON.
-    Expects fieldmap JSON name after renaming:
-      {subject}_{ses-id}_fieldmap.json
+    Runs the selected post-processing steps for every subject/session in a single traversal.
+    Subjects live in independent directories and are processed concurrently in a thread pool
+    (up to 16 workers unless max_workers is given), since the work is dominated by filesystem I/O.
+    If scans_processes > 1, the *_scans.tsv files found during the traversal are rewritten
+    afterwards in a process pool of that size instead of inline in the threads.
     """
-    for subject in subjects:
+    defer_scans = run_scans and scans_processes is not None and scans_processes > 1
+
+    def _process_one_subject(subject: str) -> List[str]:
         subject_path = os.path.join(base_dir, subject)
-        if not os.path.isdir(subject_path):
-            print(f"Directory not found: {subject_path}")
-            continue
+        if subject not in existing_subjects:
+            _log(f"Directory not found: {subject_path}")
+            return []
 
+        tsv_files = []
         for ses_path in iter_session_paths(subject_path, sessions_filter=sessions_filter):
-            ses_id = os.path.basename(ses_path)
-            func_dir = os.path.join(ses_path, "func")
-            fmap_dir = os.path.join(ses_path, "fmap")
+            tsv_files += process_session(
+                subject,
+                ses_path,
+                base_dir=base_dir,
+                run_rename=run_rename,
+                run_scans=run_scans and not defer_scans,
+                run_json=run_json,
+                b0_identifier=b0_identifier,
+                strict_scans=strict_scans,
+                dry_run=dry_run,
+                show_diff=show_diff,
+            )
+        return tsv_files
+
+    if not subjects:
+        return
+
+    # One listing of base_dir instead of an isdir() per subject
+    try:
+        with os.scandir(base_dir) as it:
+            existing_subjects = {e.name for e in it if e.is_dir()}
+    except (FileNotFoundError, NotADirectoryError):
+        existing_subjects = set()
+
+    workers = max_workers or min(16, len(subjects))
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        tsv_files = [f for found in ex.map(_process_one_subject, subjects) for f in found]
+
+    if defer_scans and tsv_files:
+        tasks = [(tsv_file, dry_run, strict_scans) for tsv_file in tsv_files]
+        with ProcessPoolExecutor(max_workers=scans_processes) as ex:
+            list(ex.map(_rewrite_one_tsv, tasks, chunksize=8))
 
-            if not os.path.isdir(func_dir) or not os.path.isdir(fmap_dir):
-                print(f"Missing func or fmap directory in: {ses_path}")
-                continue
-
-            bold_files = sorted(
-                glob.glob(os.path.join(func_dir, "*_bold.nii.gz")))
-            intended_for = [
-                "bids::" + os.path.relpath(bold_file, start=base_dir).replace(
-                    os.sep, "/")
-                for bold_file in bold_files
-            ]
 
-            pattern = os.path.join(fmap_dir, f"{subject}_{ses_id}_fieldmap.json")
-            matches = glob.glob(pattern)
-            if not matches:
-                print(f"No fieldmap JSON found in: {fmap_dir} (pattern: {pattern})")
-                continue
-
-            fmap_json_path = matches[0]
-
-            try:
-                with open(fmap_json_path, "r") as f:
-                    fmap_data = json.load(f)
+def rename_fieldmap_files(
+    subjects: List[str],
+    base_dir: str = ".",
+    sessions_filter: Optional[List[str]] = None,
+    dry_run: bool = False,
+) -> None:
+    """
+    Renames files in ses-*/fmap:
+      fieldmap1 -> magnitude
+      fieldmap2 -> fieldmap
+    """
+    process_subjects(
+        subjects,
+        base_dir=base_dir,
+        sessions_filter=sessions_filter,
+        run_rename=True,
+        run_scans=False,
+        run_json=False,
+        dry_run=dry_run,
+    )
 
-                new_data = dict(fmap_data)
-                new_data["IntendedFor"] = intended_for
-                new_data["B0FieldIdentifier"] = b0_identifier
 
-                if new_data == fmap_data:
-                    print(f"No changes needed for: {fmap_json_path}")
-                    continue
+def update_scans_tsv(
+    subjects: List[str],
+    base_dir: str = ".",
+    sessions_filter: Optional[List[str]] = None,
+    dry_run: bool = False,
+    strict: bool = False,
+) -> None:
+    """
+    Updates *_scans.tsv in each session by replacing in the 'filename' column:
+      fieldmap1 -> magnitude
+      fieldmap2 -> fieldmap
+    By default the substitution is done on the raw file bytes; strict=True parses the
+    table with pandas and edits only the 'filename' column.
+    """
+    process_subjects(
+        subjects,
+        base_dir=base_dir,
+        sessions_filter=sessions_filter,
+        run_rename=False,
+        run_scans=True,
+        run_json=False,
+        strict_scans=strict,
+        dry_run=dry_run,
+    )
 
-                if dry_run:
-                    print(f"Would update JSON: {fmap_json_path}")
-                else:
-                    print(f"Updating JSON: {fmap_json_path}")
-                    with open(fmap_json_path, "w") as f:
-                        json.dump(new_data, f, indent=4)
 
-            except Exception as e:
-                print(f"Error updating {fmap_json_path}: {e}")
+def update_fieldmap_json(
+    subjects: List[str],
+    base_dir: str = ".",
+    sessions_filter: Optional[List[str]] = None,
+    b0_identifier: str = "b0map_fmap0",
+    dry_run: bool = False,
+    diff: bool = False,
+) -> None:
+    """
+    Adds/updates IntendedFor and B0FieldIdentifier in the fieldmap JSON.
+    Expects fieldmap JSON name after renaming:
+      {subject}_{ses-id}_fieldmap.json
+    With diff=True, a unified diff of each change is printed (and, in dry-run mode,
+    files are read so only actual changes are reported).
+    """
+    process_subjects(
+        subjects,
+        base_dir=base_dir,
+        sessions_filter=sessions_filter,
+        run_rename=False,
+        run_scans=False,
+        run_json=True,
+        b0_identifier=b0_identifier,
+        dry_run=dry_run,
+        show_diff=diff,
+    )
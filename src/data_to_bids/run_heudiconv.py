@@ -60,9 +60,11 @@ __version__ = "0.1.0"
 import argparse
 import subprocess
 import sys
+from functools import lru_cache
 from pathlib import Path
 
 
+@lru_cache(maxsize=None)
 def find_repo_script(script_rel: Path) -> Path:
     """
     Walk upward from this file's directory until we find script_rel.
@@ -72,7 +74,7 @@ def find_repo_script(script_rel: Path) -> Path:
         src/data_to_bids/run_heudiconv.py
     """
     start = Path(__file__).resolve()
-    for parent in [start.parent] + list(start.parents):
+    for parent in start.parents:
         candidate = parent / script_rel
         if candidate.exists():
             return candidate
@@ -14,6 +14,16 @@ Notes:
     - MRIQC uses --participant-label for selecting subjects (typically without the
       'sub-' prefix).
     - The --no-sub flag disables submission of anonymized IQMs.
+    - All subjects given with -s are processed by one MRIQC container (a single
+      --participant-label list), so Docker startup is paid once per call. Use
+      --batch-size N to split them into several sequential container runs, and
+      --max-parallel N to run such batches concurrently.
+    - With --persistent, the wrapper keeps one MRIQC container running (entrypoint
+      'sleep infinity') and runs each analysis in it with 'docker exec', bypassing
+      run_mriqc.sh. The container is reused across calls (as long as its image and
+      mounts match) until it is removed with a separate --stop-persistent call.
+    - scripts/run_mriqc.sh is looked up under $SLPMD_REPO_ROOT first (if set), then by
+      walking upward from this file.
 
 References:
     - MRIQC usage:
@@ -26,40 +36,96 @@ __date__ = "2026-02"
 __version__ = "0.1.0"
 
 import argparse
-import subprocess
+import json
+import math
+import os
+import re
+import shlex
+import shutil
+import sys
+from functools import lru_cache
 from pathlib import Path
+from typing import Callable, List, Optional, Tuple
 
 
+# Optional repository root override; lets find_repo_script skip the upward walk
+_REPO_ROOT = os.environ.get("SLPMD_REPO_ROOT")
+
+
+@lru_cache(maxsize=None)
 def find_repo_script(script_rel: Path) -> Path:
-    start = Path(__file__).resolve()
-    for parent in [start.parent] + list(start.parents):
-        candidate = parent / script_rel
-        if candidate.exists():
-            return candidate
+    if _REPO_ROOT:
+        candidate = os.path.join(_REPO_ROOT, script_rel)
+        if os.path.exists(candidate):
+            return Path(candidate)
+
+    # Plain os.path strings: one stat per level, no Path/stat_result objects
+    start = os.path.realpath(__file__)
+    parent = os.path.dirname(start)
+    while True:
+        candidate = os.path.join(parent, script_rel)
+        if os.path.exists(candidate):
+            return Path(candidate)
+        next_parent = os.path.dirname(parent)
+        if next_parent == parent:
+            break
+        parent = next_parent
     raise FileNotFoundError(f"Could not find {script_rel} by walking up from {start}")
 
 
+_LEVELS = frozenset({"participant", "group"})
+
+# BIDS labels are alphanumeric; the entity prefix is optional on the command line
+_SUB_RE = re.compile(r"(?:sub-)?[A-Za-z0-9]+")
+_SES_RE = re.compile(r"(?:ses-)?[A-Za-z0-9]+")
+
+
+def _level(v: str) -> str:
+    if v not in _LEVELS:
+        raise argparse.ArgumentTypeError(f"invalid analysis level: {v!r} (choose 'participant' or 'group')")
+    return v
+
+
+def _positive_int(v: str) -> int:
+    try:
+        n = int(v)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid integer: {v!r}")
+    if n <= 0:
+        raise argparse.ArgumentTypeError(f"must be > 0: {v!r}")
+    return n
+
+
 def build_parser() -> argparse.ArgumentParser:
     p = argparse.ArgumentParser(
         description="Python wrapper that calls scripts/run_mriqc.sh with provided arguments."
     )
 
-    p.add_argument("-b", "--base", required=True, help="Host base path.")
-    p.add_argument("-i", "--input-dir", required=True, help="Input BIDS dir (relative to base or absolute).")
-    p.add_argument("-O", "--output-dir", required=True, help="Output dir (relative to base or absolute).")
+    # Required for every run; checked in main() so --stop-persistent can be used on its own
+    p.add_argument("-b", "--base", help="Host base path.")
+    p.add_argument("-i", "--input-dir", help="Input BIDS dir (relative to base or absolute).")
+    p.add_argument("-O", "--output-dir", help="Output dir (relative to base or absolute).")
     p.add_argument(
         "-a", "--analysis-level",
-        choices=["participant", "group"],
-        required=True,
-        help="MRIQC analysis level.",
+        type=_level,
+        help="MRIQC analysis level (participant or group).",
     )
 
     p.add_argument("-s", "--subjects", nargs="+", default=None, help="Subject IDs (md101 or sub-md101).")
     p.add_argument("-e", "--sessions", nargs="+", default=None, help="Session IDs (mrt1 or ses-mrt1).")
 
-    p.add_argument("--nprocs", type=int, default=4, help="Number of processes.")
-    p.add_argument("--omp-nthreads", type=int, default=2, help="OMP threads per process.")
-    p.add_argument("--work-dir", default=None, help="Working directory (relative to base or absolute).")
+    p.add_argument("--batch-size", type=_positive_int, default=None,
+                   help="Max subjects per MRIQC container (participant level). "
+                        "Default: all subjects in a single container.")
+
+    p.add_argument("--max-parallel", type=_positive_int, default=1,
+                   help="Run up to N subject batches concurrently (participant level).")
+
+    p.add_argument("--nprocs", type=_positive_int, default=4, help="Number of processes.")
+    p.add_argument("--omp-nthreads", type=_positive_int, default=2, help="OMP threads per process.")
+    p.add_argument("--work-dir", default=None,
+                   help="Working directory (relative to base or absolute). Concurrent batches "
+                        "(--max-parallel) each use their own batch-<i> subdirectory.")
     p.add_argument("--image", default="nipreps/mriqc:24.0.2", help="Docker image tag.")
 
     p.add_argument("--allow-submission", action="store_true",
@@ -68,7 +134,20 @@ def build_parser() -> argparse.ArgumentParser:
                    help="Do NOT pass --verbose-reports (default behavior is to pass --verbose-reports).")
     p.add_argument("--sudo", action="store_true",
                    help="Run docker with sudo (passed through to scripts/run_mriqc.sh).")
-    p.add_argument("--dry-run", action="store_true", help="Print commands, do not run.")
+    p.add_argument("--quiet", action="store_true", help="Do not print the commands being run.")
+    p.add_argument("--log-file", default=None,
+                   help="Append the output of the MRIQC runs to this file instead of the terminal.")
+    p.add_argument("--dry-run", action="store_true",
+                   help="Print the run_mriqc.sh command, do not run it.")
+
+    p.add_argument("--persistent", action="store_true",
+                   help="Run MRIQC via 'docker exec' in a long-lived container (started on first use) "
+                        "instead of a fresh 'docker run' per call. Extra args are passed to mriqc.")
+    p.add_argument("--container-name", default="slpmd-mriqc",
+                   help="Name of the persistent MRIQC container.")
+    p.add_argument("--stop-persistent", action="store_true",
+                   help="Only stop and remove the persistent container (no MRIQC run); "
+                        "-b/-i/-O/-a are not needed.")
 
     p.add_argument("--script", default=None,
                    help="Path to run_mriqc.sh (defaults to scripts/run_mriqc.sh found from repo root).")
@@ -79,15 +158,25 @@ def build_parser() -> argparse.ArgumentParser:
     return p
 
 
-def main() -> int:
-    args = build_parser().parse_args()
+# Optional run_mriqc.sh arguments: (args attribute, flag, kind). "flag" is a bare switch,
+# "list" takes all values. Subjects and --work-dir are added per batch.
+_FLAGS = (
+    ("sessions", "-e", "list"),
+    ("allow_submission", "--allow-submission", "flag"),
+    ("no_verbose_reports", "--no-verbose-reports", "flag"),
+    ("sudo", "--sudo", "flag"),
+    ("dry_run", "--dry-run", "flag"),
+)
 
-    sh_path = Path(args.script).expanduser().resolve() if args.script else find_repo_script(
-        Path("scripts") / "run_mriqc.sh"
-    )
 
+def build_command(
+    sh_path: str,
+    args: argparse.Namespace,
+    subjects: Optional[List[str]],
+    work_subdir: Optional[str] = None,
+) -> List[str]:
     cmd = [
-        str(sh_path),
+        sh_path,
         "-b", args.base,
         "-i", args.input_dir,
         "-O", args.output_dir,
@@ -97,28 +186,313 @@ def main() -> int:
         "--image", args.image,
     ]
 
-    if args.subjects:
-        cmd += ["-s", *args.subjects]
-    if args.sessions:
-        cmd += ["-e", *args.sessions]
+    if subjects:
+        cmd.append("-s")
+        cmd.extend(subjects)
+    for attr, flag, kind in _FLAGS:
+        value = getattr(args, attr)
+        if not value:
+            continue
+        cmd.append(flag)
+        if kind == "list":
+            cmd.extend(value)
     if args.work_dir:
-        cmd += ["--work-dir", args.work_dir]
-    if args.allow_submission:
-        cmd += ["--allow-submission"]
-    if args.no_verbose_reports:
-        cmd += ["--no-verbose-reports"]
-    if args.sudo:
-        cmd += ["--sudo"]
-    if args.dry_run:
-        cmd += ["--dry-run"]
+        cmd.append("--work-dir")
+        cmd.append(os.path.join(args.work_dir, work_subdir) if work_subdir else args.work_dir)
     if args.extra:
-        cmd += args.extra
+        cmd.extend(args.extra)
+
+    return cmd
+
+
+def _subject_batches(args: argparse.Namespace) -> List[Optional[List[str]]]:
+    """
+    Split the requested subjects into per-container batches.
+    By default all subjects go to a single MRIQC container (one --participant-label list),
+    so container startup is paid once; --batch-size bounds the subjects per container.
+    With --max-parallel N (and no --batch-size) the subjects are split into N batches.
+    Sessions are not split: every batch gets the full -e list.
+    """
+    if not args.subjects or args.analysis_level != "participant":
+        return [args.subjects]
+    size = args.batch_size or math.ceil(len(args.subjects) / args.max_parallel)
+    return [args.subjects[i:i + size] for i in range(0, len(args.subjects), size)]
+
+
+def _run(spawn: Callable, cmd: List[str], **kwargs):
+    # Keep CPython on its posix_spawn() fast path (no fork() of this interpreter, which matters
+    # when the wrapper runs inside a large pipeline driver). The preconditions are:
+    #   - argv is a list (no shell=True) and the executable has a directory component,
+    #     hence the explicit shutil.which() lookup of "docker"/"sudo";
+    #   - no preexec_fn, pass_fds, cwd, start_new_session, process_group, user/group/umask;
+    #   - close_fds=False (or a libc with posix_spawn_file_actions_addclosefrom_np);
+    #   - redirected std streams, if any, must not land on fds 0-2.
+    # Do not add any of the above without checking Popen._execute_child.
+    # spawn is subprocess.run, imported once in main() so --help/--dry-run never load subprocess.
+    executable = shutil.which(cmd[0]) or cmd[0]
+    return spawn(cmd, executable=executable, close_fds=False, **kwargs)
+
+
+def _host_path(base: str, path: str) -> str:
+    # Same rule as run_mriqc.sh: absolute paths are used as-is, others are relative to base
+    return path if os.path.isabs(path) else os.path.join(base, path)
+
+
+def _docker(args: argparse.Namespace) -> List[str]:
+    return ["sudo", "docker"] if args.sudo else ["docker"]
+
+
+def _persistent_mounts(args: argparse.Namespace) -> List[Tuple[str, str, bool]]:
+    # (host path, container path, read-only), same mounts as run_mriqc.sh. Host paths are made
+    # absolute: 'docker run -v' treats a relative source as a named volume.
+    mounts = [
+        (os.path.abspath(_host_path(args.base, args.input_dir)), "/data", True),
+        (os.path.abspath(_host_path(args.base, args.output_dir)), "/out", False),
+    ]
+    if args.work_dir:
+        mounts.append((os.path.abspath(_host_path(args.base, args.work_dir)), "/work", False))
+    return mounts
+
+
+def build_start_command(args: argparse.Namespace) -> List[str]:
+    """
+    docker run command for the persistent container: same mounts as run_mriqc.sh, but the
+    entrypoint just sleeps so MRIQC runs can be exec'd into it.
+    Mounts are fixed at creation; use --stop-persistent before changing -i/-O/--work-dir.
+    """
+    cmd = [*_docker(args), "run", "-d", "--name", args.container_name]
+    for host, target, read_only in _persistent_mounts(args):
+        cmd.extend(("-v", f"{host}:{target}:ro" if read_only else f"{host}:{target}"))
+    cmd.extend(("--entrypoint", "sleep", args.image, "infinity"))
+    return cmd
+
+
+def build_exec_command(
+    args: argparse.Namespace,
+    subjects: Optional[List[str]],
+    work_subdir: Optional[str] = None,
+) -> List[str]:
+    """
+    docker exec command running MRIQC in the persistent container; mirrors the mriqc call
+    assembled by run_mriqc.sh (labels without 'sub-'/'ses-').
+    """
+    cmd = [
+        *_docker(args), "exec", args.container_name,
+        "mriqc", "/data", "/out", args.analysis_level,
+        "--nprocs", str(args.nprocs),
+        "--omp-nthreads", str(args.omp_nthreads),
+    ]
+
+    if args.work_dir:
+        cmd.extend(("--work-dir", f"/work/{work_subdir}" if work_subdir else "/work"))
+    if args.analysis_level == "participant":
+        if subjects:
+            cmd.append("--participant-label")
+            cmd.extend(s.removeprefix("sub-") for s in subjects)
+        if args.sessions:
+            cmd.append("--session-id")
+            cmd.extend(s.removeprefix("ses-") for s in args.sessions)
+    if not args.allow_submission:
+        cmd.append("--no-sub")
+    if not args.no_verbose_reports:
+        cmd.append("--verbose-reports")
+    if args.extra:
+        cmd.extend(args.extra[1:] if args.extra[0] == "--" else args.extra)
+
+    return cmd
+
+
+def _reuse_running_container(args: argparse.Namespace, spawn: Callable) -> bool:
+    """
+    True if the persistent container is running and was started for the same image and
+    mounts; raises RuntimeError if it is running with a different configuration.
+    """
+    ps = _run(
+        spawn,
+        [*_docker(args), "ps", "-q", "--filter", f"name=^{args.container_name}$"],
+        capture_output=True, text=True, check=True,
+    )
+    if not ps.stdout.strip():
+        return False
+
+    inspect = _run(
+        spawn,
+        [*_docker(args), "inspect", "--format", "{{json .Config.Image}} {{json .Mounts}}",
+         args.container_name],
+        capture_output=True, text=True, check=True,
+    )
+    image_json, _, mounts_json = inspect.stdout.strip().partition(" ")
+    running = {
+        (os.path.normpath(m["Source"]), m["Destination"], not m["RW"])
+        for m in json.loads(mounts_json or "[]")
+    }
+    expected = {
+        (os.path.normpath(host), target, read_only)
+        for host, target, read_only in _persistent_mounts(args)
+    }
+    if json.loads(image_json) != args.image or running != expected:
+        raise RuntimeError(
+            f"running container {args.container_name!r} was started with a different image "
+            "or mounts; remove it with --stop-persistent or use another --container-name"
+        )
+    return True
+
+
+def ensure_persistent_container(args: argparse.Namespace, spawn: Callable) -> None:
+    if _reuse_running_container(args, spawn):
+        return
+
+    # Remove a stopped container left over under the same name (never a running one, which
+    # another wrapper may have just started), then start a fresh one
+    stopped = _run(
+        spawn,
+        [*_docker(args), "ps", "-aq", "--filter", f"name=^{args.container_name}$",
+         "--filter", "status=exited", "--filter", "status=created"],
+        capture_output=True, text=True, check=True,
+    )
+    if stopped.stdout.strip():
+        _run(spawn, [*_docker(args), "rm", args.container_name], capture_output=True)
+
+    os.makedirs(_host_path(args.base, args.output_dir), exist_ok=True)
+    if args.work_dir:
+        os.makedirs(_host_path(args.base, args.work_dir), exist_ok=True)
+    started = _run(spawn, build_start_command(args), capture_output=True, text=True)
+    if started.returncode != 0:
+        # Most likely a name conflict with a wrapper that started the container concurrently
+        if _reuse_running_container(args, spawn):
+            return
+        raise RuntimeError(
+            f"could not start container {args.container_name!r}: {started.stderr.strip()}"
+        )
+
+
+def main() -> int:
+    args = _PARSER.parse_args()
+
+    stop_cmd = [*_docker(args), "rm", "-f", args.container_name]
+    if args.stop_persistent:
+        if not args.quiet:
+            print("Stop persistent container:\n  " + shlex.join(stop_cmd))
+        if args.dry_run:
+            return 0
+        sys.stdout.flush()
+        os.execvp(stop_cmd[0], stop_cmd)
+
+    missing = [
+        flag for flag, value in (
+            ("-b/--base", args.base),
+            ("-i/--input-dir", args.input_dir),
+            ("-O/--output-dir", args.output_dir),
+            ("-a/--analysis-level", args.analysis_level),
+        )
+        if value is None
+    ]
+    if missing:
+        _PARSER.error(f"the following arguments are required: {', '.join(missing)}")
+
+    # Reject malformed labels here rather than after a container has been started
+    bad = [x for x in (args.subjects or ()) if not _SUB_RE.fullmatch(x)]
+    if bad:
+        _PARSER.error(f"invalid subject IDs: {bad}")
+    bad = [x for x in (args.sessions or ()) if not _SES_RE.fullmatch(x)]
+    if bad:
+        _PARSER.error(f"invalid session IDs: {bad}")
+
+    # Concurrent MRIQC runs must not share a nipype working directory
+    batches = _subject_batches(args)
+    if args.work_dir and args.max_parallel > 1 and len(batches) > 1:
+        work_subdirs = [f"batch-{i}" for i in range(1, len(batches) + 1)]
+    else:
+        work_subdirs = [None] * len(batches)
+
+    if args.persistent:
+        # run_mriqc.sh is bypassed, so repeat its checks: 'docker run -v' would otherwise
+        # create a missing input dir (empty, root-owned) and MRIQC would only fail later
+        if not os.path.isdir(args.base):
+            _PARSER.error(f"base path is not a directory: {args.base}")
+        input_host = _host_path(args.base, args.input_dir)
+        if not os.path.isdir(input_host):
+            _PARSER.error(f"input BIDS dir not found: {input_host}")
+        cmds = [build_exec_command(args, b, w) for b, w in zip(batches, work_subdirs)]
+    else:
+        sh_path = os.path.realpath(os.path.expanduser(args.script)) if args.script else str(
+            find_repo_script(Path("scripts") / "run_mriqc.sh")
+        )
+        cmds = [build_command(sh_path, args, b, w) for b, w in zip(batches, work_subdirs)]
+
+    if not args.quiet:
+        if args.persistent:
+            print("Persistent container (started if not running):\n  " + shlex.join(build_start_command(args)))
+        for cmd in cmds:
+            print("Command:\n  " + shlex.join(cmd))
+
+    # Nothing to execute: don't fork a shell just to have it echo the docker call
+    if args.dry_run:
+        return 0
+
+    import subprocess
+
+    spawn = subprocess.run
+
+    # Fail fast if the Docker daemon is down instead of after starting the shell runner.
+    # Skipped with --sudo, where the probe itself could prompt for a password.
+    if not args.sudo:
+        try:
+            _run(spawn, ["docker", "info"], capture_output=True, check=True, timeout=10)
+        except (OSError, subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            _PARSER.error("cannot reach the Docker daemon ('docker info' failed); is Docker running?")
+
+    if args.persistent:
+        try:
+            ensure_persistent_container(args, spawn)
+        except RuntimeError as e:
+            _PARSER.error(str(e))
+        for w in work_subdirs:
+            if w:
+                os.makedirs(os.path.join(_host_path(args.base, args.work_dir), w), exist_ok=True)
+
+    # MRIQC output is never captured: children write straight to the inherited stdout/stderr,
+    # or with --log-file to a raw fd the kernel appends to, with no copying through Python.
+    log_fd = None
+    if args.log_file:
+        log_fd = os.open(args.log_file, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    stdio = {"stdout": log_fd, "stderr": log_fd}
+
+    try:
+        if args.max_parallel > 1 and len(cmds) > 1:
+            # Each worker thread just blocks on its own container run. stdin is closed so
+            # concurrent runs never share the terminal (run_mriqc.sh then skips 'docker run -it').
+            from concurrent.futures import ThreadPoolExecutor
+
+            with ThreadPoolExecutor(max_workers=args.max_parallel) as ex:
+                returncodes = list(ex.map(
+                    lambda c: _run(spawn, c, stdin=subprocess.DEVNULL, **stdio).returncode, cmds
+                ))
+            return next((rc for rc in returncodes if rc != 0), 0)
+
+        # As in parallel mode, a failed batch does not stop the others; the first nonzero
+        # exit status is returned.
+        *leading, last = cmds
+        returncodes = [_run(spawn, cmd, **stdio).returncode for cmd in leading]
+        failed = next((rc for rc in returncodes if rc != 0), 0)
+        if failed:
+            _run(spawn, last, **stdio)
+            return failed
+
+        # Nothing left to do after the last run: replace this process instead of fork + wait.
+        # The exit status seen by the caller is the command's own.
+        sys.stdout.flush()
+        if log_fd is not None:
+            os.dup2(log_fd, 1)
+            os.dup2(log_fd, 2)
+        os.execvp(last[0], last)
+    finally:
+        if log_fd is not None:
+            os.close(log_fd)
 
-    print("Command:")
-    print("  " + " ".join(cmd))
 
-    subprocess.run(cmd, check=True)
-    return 0
+# Built once at import; main() may be called repeatedly when used as a library
+_PARSER = build_parser()
 
 
 if __name__ == "__main__":